@@ -1,8 +1,10 @@
 import os
 import json
+import queue
 import sqlite3
+import threading
+import time
 from contextlib import contextmanager
-from datetime import datetime
 
 # Папка с данными (см. docker‑compose → volumes)
 DATA_DIR = "/app/data"
@@ -10,93 +12,371 @@ os.makedirs(DATA_DIR, exist_ok=True)
 
 DB_FILE = os.path.join(DATA_DIR, "user_config.db")
 
+# PRAGMA'ы действуют в пределах соединения, поэтому применяются к каждому новому.
+# synchronous=NORMAL под WAL убирает лишний fsync на каждый commit,
+# temp_store/cache_size/mmap_size держат рабочий набор в памяти.
+_CONN_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA cache_size=-20000;",
+    "PRAGMA mmap_size=268435456;",
+    "PRAGMA foreign_keys=ON;",
+    "PRAGMA busy_timeout=5000;",
+)
+
+
+def _apply_pragmas(conn: sqlite3.Connection) -> None:
+    for pragma in _CONN_PRAGMAS:
+        conn.execute(pragma)
+
+
+def now_iso() -> str:
+    """Текущее локальное время до секунд в ISO‑формате (для last_check_time)."""
+    return time.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+# ─────────────────────────── схема ──────────────────────────────────────────
+# Настройки Jira‑уведомлений — битовая маска, по биту на тип события;
+# порядок совпадает с порядком пунктов меню Jira.
+JIRA_BITS = {
+    "created": 1,
+    "assigned": 2,
+    "update": 4,
+    "comment": 8,
+    "mention_description": 16,
+    "mention_comment": 32,
+    "worklog": 64,
+}
+_JIRA_DEFAULT_MASK = 0x3F  # всё, кроме worklog
+_DEFAULT_HOST = "imap.yandex.ru"
+
+_SCHEMA_SQL = f"""
+    CREATE TABLE IF NOT EXISTS user_configs (
+        user_id          TEXT PRIMARY KEY,
+        email_value      TEXT,
+        email_password   TEXT,
+        email_host       TEXT    NOT NULL DEFAULT '{_DEFAULT_HOST}',
+        jira_mask        INTEGER NOT NULL DEFAULT {_JIRA_DEFAULT_MASK},
+        mail_notif       INTEGER NOT NULL DEFAULT 0,
+        quiet_notif      INTEGER NOT NULL DEFAULT 1,
+        last_uid         INTEGER,
+        last_check_time  TEXT
+    )
+"""
+_COLUMNS = (
+    "email_value",
+    "email_password",
+    "email_host",
+    "jira_mask",
+    "mail_notif",
+    "quiet_notif",
+    "last_uid",
+    "last_check_time",
+)
+_SELECT_COLUMNS = ", ".join(_COLUMNS)
+
+# Весь SQL — модульные константы: sqlite3 кэширует подготовленные выражения
+# по тексту запроса, и одинаковая строка на каждом вызове держит их «горячими».
+_LOAD_SQL = f"SELECT {_SELECT_COLUMNS} FROM user_configs WHERE user_id=?"
+_LOAD_ALL_SQL = f"SELECT user_id, {_SELECT_COLUMNS} FROM user_configs"
+_INSERT_ROW_SQL = (
+    f"INSERT INTO user_configs (user_id, {_SELECT_COLUMNS}) "
+    f"VALUES (?{', ?' * len(_COLUMNS)})"
+)
+_UPSERT_SQL = (
+    _INSERT_ROW_SQL
+    + " ON CONFLICT(user_id) DO UPDATE SET "
+    + ", ".join(f"{col}=excluded.{col}" for col in _COLUMNS)
+)
+_INSERT_DEFAULT_SQL = (
+    "INSERT INTO user_configs (user_id, last_check_time) VALUES (?, ?) "
+    "ON CONFLICT(user_id) DO NOTHING"
+)
+_SET_EMAIL_SQL = "UPDATE user_configs SET email_value=?, email_password=? WHERE user_id=?"
+_TOGGLE_MAIL_SQL = "UPDATE user_configs SET mail_notif = NOT mail_notif WHERE user_id=?"
+_TOGGLE_QUIET_SQL = "UPDATE user_configs SET quiet_notif = NOT quiet_notif WHERE user_id=?"
+_SET_JIRA_BIT_SQL = "UPDATE user_configs SET jira_mask = (jira_mask & ~?) | ? WHERE user_id=?"
+# в SQLite нет XOR: (a | b) - (a & b) == a ^ b
+_TOGGLE_JIRA_BIT_SQL = (
+    "UPDATE user_configs SET jira_mask = (jira_mask | ?1) - (jira_mask & ?1) "
+    "WHERE user_id=?2"
+)
+_USER_FIELDS_SQL = {
+    name: f"UPDATE user_configs SET {name}=? WHERE user_id=?"
+    for name in ("last_uid", "last_check_time")
+}
+_DATA_VERSION_SQL = "PRAGMA data_version;"
+
+
+def _jira_mask(jira) -> int:
+    """Маска из int как есть; из dict {тип: bool} старого формата cfg_json."""
+    if jira is None:
+        return _JIRA_DEFAULT_MASK
+    if isinstance(jira, int):
+        return jira
+    return sum(bit for e_type, bit in JIRA_BITS.items() if jira.get(e_type))
+
+
+def _cfg_to_row(cfg: dict) -> tuple:
+    """dict‑конфиг (в т.ч. старый формат cfg_json) → значения колонок _COLUMNS."""
+    mail = cfg.get("email") or {}
+    notif = cfg.get("notifications") or {}
+    return (
+        mail.get("value"),
+        mail.get("password"),
+        mail.get("host") or _DEFAULT_HOST,
+        _jira_mask(notif.get("jira")),
+        int(bool(notif.get("mail", False))),
+        int(bool(notif.get("quiet_notifications", True))),
+        cfg.get("last_uid"),
+        cfg.get("last_check_time") or now_iso(),
+    )
+
+
+def _row_to_cfg(row: tuple) -> dict:
+    """Значения колонок _COLUMNS → dict в привычном для остального кода виде."""
+    value, password, host, mask, mail_on, quiet_on, last_uid, last_check = row
+    return {
+        "email": {"value": value, "password": password, "host": host},
+        "notifications": {
+            "jira": mask,
+            "mail": bool(mail_on),
+            "quiet_notifications": bool(quiet_on),
+        },
+        "last_uid": last_uid,
+        "last_check_time": last_check,
+    }
+
+
+def _default_cfg() -> dict:
+    """Базовая конфигурация для пользователя, которого ещё нет в БД."""
+    return _row_to_cfg(
+        (
+            None,
+            None,
+            _DEFAULT_HOST,
+            _JIRA_DEFAULT_MASK,
+            0,
+            1,
+            None,
+            now_iso(),
+        )
+    )
+
+
 # ────────────────────── инициализация SQLite‑файла ──────────────────────────
+def _migrate_json_table(conn: sqlite3.Connection) -> None:
+    """Переносит данные из старой таблицы с единым cfg_json в колонки."""
+    conn.execute("ALTER TABLE user_configs RENAME TO user_configs_json;")
+    conn.execute(_SCHEMA_SQL)
+    rows = conn.execute("SELECT user_id, cfg_json FROM user_configs_json").fetchall()
+    conn.executemany(
+        _INSERT_ROW_SQL,
+        [(uid, *_cfg_to_row(json.loads(cfg))) for uid, cfg in rows],
+    )
+    conn.execute("DROP TABLE user_configs_json;")
+
+
 def _init_db() -> None:
     """
-    Создаёт файл БД и таблицу, если их ещё нет.
-    Переключает SQLite в WAL‑режим (одновременные чтение/запись из разных процессов).
+    Создаёт файл БД и таблицу, если их ещё нет (и мигрирует старую схему).
+    Переключает SQLite в WAL‑режим (одновременные чтение/запись из разных процессов);
+    режим журнала хранится в самом файле, так что достаточно сделать это один раз.
     """
-    with sqlite3.connect(DB_FILE) as conn:
+    conn = sqlite3.connect(DB_FILE, timeout=5, isolation_level=None)
+    try:
         conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS user_configs (
-                user_id   TEXT PRIMARY KEY,
-                cfg_json  TEXT NOT NULL
-            )
-            """
-        )
-        conn.commit()
+        _apply_pragmas(conn)
+        # бот и redirect‑server стартуют одновременно — миграцию делает один
+        conn.execute("BEGIN IMMEDIATE;")
+        columns = {r[1] for r in conn.execute("PRAGMA table_info(user_configs);")}
+        if "cfg_json" in columns:
+            _migrate_json_table(conn)
+        else:
+            conn.execute(_SCHEMA_SQL)
+        conn.execute("COMMIT;")
+    finally:
+        conn.close()
 
 
 _init_db()
 
 
+# ─────────────────────── пул соединений ─────────────────────────────────────
+# Одно долгоживущее соединение на запись (под локом) + пул read‑only
+# соединений: под WAL читатели не блокируют писателя и друг друга.
+_READERS_SIZE = os.cpu_count() or 4
+
+
+def _open_conn(read_only: bool = False) -> sqlite3.Connection:
+    if read_only:
+        conn = sqlite3.connect(
+            f"file:{DB_FILE}?mode=ro",
+            uri=True,
+            timeout=5,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+    else:
+        conn = sqlite3.connect(
+            DB_FILE, timeout=5, check_same_thread=False, isolation_level=None
+        )
+    _apply_pragmas(conn)
+    return conn
+
+
+_WRITER = _open_conn()
+_WRITER_LOCK = threading.Lock()
+
+_READERS: queue.Queue = queue.Queue(maxsize=_READERS_SIZE)
+for _ in range(_READERS_SIZE):
+    _READERS.put(_open_conn(read_only=True))
+
+
 @contextmanager
-def _conn():
-    """Соединение с таймаутом ожидания блокировки (3 с)."""
-    conn = sqlite3.connect(DB_FILE, timeout=5)
+def _read_conn():
+    """Берёт read‑only соединение из пула и возвращает его обратно."""
+    conn = _READERS.get()
     try:
-        conn.execute("PRAGMA busy_timeout=3000;")
         yield conn
-        conn.commit()
     finally:
-        conn.close()
+        _READERS.put(conn)
+
+
+@contextmanager
+def _write_conn():
+    """
+    Единственное соединение на запись.
+    Неявные транзакции sqlite3 отключены; транзакция открывается сразу
+    как BEGIN IMMEDIATE, чтобы не ловить SQLITE_BUSY при повышении
+    блокировки с чтения до записи.
+    """
+    with _WRITER_LOCK:
+        _WRITER.execute("BEGIN IMMEDIATE;")
+        try:
+            yield _WRITER
+        except BaseException:
+            _WRITER.execute("ROLLBACK;")
+            raise
+        _WRITER.execute("COMMIT;")
+
+
+# ─────────────────────── кэш конфигов ───────────────────────────────────────
+# В БД пишут два процесса (бот и redirect‑server), поэтому кэш сверяется с
+# PRAGMA data_version. Её опрашивает отдельное read‑only соединение под своим
+# маленьким локом: чтения не ждут писателя с его BEGIN IMMEDIATE. Значение
+# меняется после commit'а из любого другого соединения (в том числе нашего
+# писателя) — тогда кэш сбрасывается целиком. Так что кэш живёт только между
+# commit'ами: свою запись в него не кладём, её всё равно сбросит следующее чтение.
+# _cache_gen растёт при любой инвалидации (чужой commit или своя запись):
+# прочитанное из БД кладётся в кэш, только если поколение не сменилось
+# с начала SELECT'а, иначе строка могла устареть.
+_CFG_CACHE: dict[str, dict] = {}
+_CACHE_LOCK = threading.Lock()
+_cache_version: int | None = None
+_cache_gen = 0
+_VERSION_CONN = _open_conn(read_only=True)
+_VERSION_LOCK = threading.Lock()
+
+
+def _sync_cache() -> int:
+    """Сбрасывает кэш, если БД меняли извне; возвращает текущее поколение."""
+    global _cache_version, _cache_gen
+    with _VERSION_LOCK:
+        version = _VERSION_CONN.execute(_DATA_VERSION_SQL).fetchone()[0]
+    with _CACHE_LOCK:
+        if version != _cache_version:
+            _CFG_CACHE.clear()
+            _cache_version = version
+            _cache_gen += 1
+        return _cache_gen
+
+
+def _invalidate(key: str) -> None:
+    """После своей записи: новое поколение и сброс ключа."""
+    global _cache_gen
+    with _CACHE_LOCK:
+        _cache_gen += 1
+        _CFG_CACHE.pop(key, None)
 
 
 # ─────────────────────── низкоуровневые helpers ─────────────────────────────
 def _load_cfg(uid: int) -> dict | None:
-    with _conn() as c:
-        cur = c.execute("SELECT cfg_json FROM user_configs WHERE user_id=?", (str(uid),))
-        row = cur.fetchone()
-        return json.loads(row[0]) if row else None
+    """
+    Конфиг из кэша либо из БД. Возвращается общий для всех вызовов dict:
+    менять его нельзя — для изменений есть функции ниже.
+    """
+    key = str(uid)
+    gen = _sync_cache()
+    with _CACHE_LOCK:
+        cfg = _CFG_CACHE.get(key)
+    if cfg is not None:
+        return cfg
+
+    with _read_conn() as c:
+        # курсор не переживает блок: иначе read‑транзакция осталась бы открытой
+        # на соединении, вернувшемся в пул
+        row = c.execute(_LOAD_SQL, (key,)).fetchone()
+    if not row:
+        return None
+
+    cfg = _row_to_cfg(row)
+    with _CACHE_LOCK:
+        # пока читали, кэш мог быть сброшен или строку переписали —
+        # тогда прочитанное уже устарело
+        if gen == _cache_gen:
+            _CFG_CACHE[key] = cfg
+    return cfg
+
+
+def _insert_default(c: sqlite3.Connection, key: str) -> None:
+    """Строка с дефолтами колонок, если её ещё нет."""
+    c.execute(_INSERT_DEFAULT_SQL, (key, now_iso()))
 
 
 def _save_cfg(uid: int, cfg: dict) -> None:
-    with _conn() as c:
-        c.execute(
-            """
-            INSERT INTO user_configs (user_id, cfg_json)
-            VALUES (?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET cfg_json=excluded.cfg_json
-            """,
-            (str(uid), json.dumps(cfg, ensure_ascii=False)),
-        )
+    key = str(uid)
+    try:
+        with _write_conn() as c:
+            c.execute(_UPSERT_SQL, (key, *_cfg_to_row(cfg)))
+    finally:
+        _invalidate(key)
 
 
-def _default_cfg() -> dict:
-    """Базовая конфигурация для нового пользователя."""
-    return {
-        "email": {"value": None, "password": None, "host": "imap.yandex.ru"},
-        "notifications": {
-            "jira": {
-                "created": True,
-                "assigned": True,
-                "update": True,
-                "comment": True,
-                "mention_description": True,
-                "mention_comment": True,
-                "worklog": False,
-            },
-            "mail": False,
-            "quiet_notifications": True,
-        },
-        "last_uid": None,
-        "last_check_time": datetime.now().isoformat(),
-    }
+def _update(uid: int, *statements: tuple[str, tuple]) -> dict:
+    """
+    Точечные UPDATE'ы (sql, params) одной транзакцией; user_id дописывается
+    последним параметром. Строка с дефолтами создаётся в той же транзакции,
+    если её ещё нет. Возвращает обновлённый конфиг, прочитанный в той же
+    транзакции, — вызывающему не нужно перечитывать его для отрисовки.
+    """
+    key = str(uid)
+    try:
+        with _write_conn() as c:
+            _insert_default(c, key)
+            for sql, params in statements:
+                c.execute(sql, (*params, key))
+            row = c.execute(_LOAD_SQL, (key,)).fetchone()
+    finally:
+        _invalidate(key)
+    return _row_to_cfg(row)
 
 
 # ───────────────────────── публичное API ────────────────────────────────────
 def ensure_user_config(user_id: int) -> None:
     """Гарантирует наличие строки в таблице."""
     if _load_cfg(user_id) is None:
-        _save_cfg(user_id, _default_cfg())
+        with _write_conn() as c:
+            _insert_default(c, str(user_id))
 
 
 def get_user_config(user_id: int) -> dict:
-    """Читает конфиг пользователя (создаёт дефолт при необходимости)."""
-    ensure_user_config(user_id)
-    return _load_cfg(user_id)
+    """
+    Читает конфиг пользователя. Если строки ещё нет — отдаёт дефолт,
+    ничего не записывая: строку создают /start и функции‑мутаторы.
+    """
+    cfg = _load_cfg(user_id)
+    return cfg if cfg is not None else _default_cfg()
 
 
 def update_user_config(user_id: int, cfg: dict) -> None:
@@ -105,24 +385,17 @@ def update_user_config(user_id: int, cfg: dict) -> None:
 
 
 # ---- операции с e‑mail -----------------------------------------------------
-def set_email_credentials(user_id: int, email_value: str, password: str) -> None:
-    cfg = get_user_config(user_id)
-    cfg["email"]["value"] = email_value
-    cfg["email"]["password"] = password
-    _save_cfg(user_id, cfg)
+def set_email_credentials(user_id: int, email_value: str, password: str) -> dict:
+    return _update(user_id, (_SET_EMAIL_SQL, (email_value, password)))
 
 
-def clear_email_credentials(user_id: int) -> None:
-    cfg = get_user_config(user_id)
-    cfg["email"]["value"] = None
-    cfg["email"]["password"] = None
-    _save_cfg(user_id, cfg)
+def clear_email_credentials(user_id: int) -> dict:
+    return set_email_credentials(user_id, None, None)
 
 
 def get_email_credentials(user_id: int):
-    cfg = get_user_config(user_id)
-    mail = cfg.get("email", {})
-    return mail.get("value"), mail.get("password"), mail.get("host")
+    mail = get_user_config(user_id)["email"]
+    return mail["value"], mail["password"], mail["host"]
 
 
 # ---- операции с уведомлениями ---------------------------------------------
@@ -130,24 +403,27 @@ def get_notifications_config(user_id: int) -> dict:
     return get_user_config(user_id)["notifications"]
 
 
-def toggle_mail_notifications(user_id: int) -> None:
-    cfg = get_user_config(user_id)
-    cfg["notifications"]["mail"] = not cfg["notifications"]["mail"]
-    _save_cfg(user_id, cfg)
+# Мутаторы возвращают обновлённый конфиг пользователя.
+def toggle_mail_notifications(user_id: int) -> dict:
+    return _update(user_id, (_TOGGLE_MAIL_SQL, ()))
 
 
-def toggle_quiet_notifications(user_id: int) -> None:
-    cfg = get_user_config(user_id)
-    cur = cfg["notifications"].get("quiet_notifications", True)
-    cfg["notifications"]["quiet_notifications"] = not cur
-    _save_cfg(user_id, cfg)
+def toggle_quiet_notifications(user_id: int) -> dict:
+    return _update(user_id, (_TOGGLE_QUIET_SQL, ()))
+
 
+def set_jira_notification(user_id: int, event_type: str, value: bool) -> dict:
+    bit = JIRA_BITS.get(event_type)
+    if bit is None:
+        return get_user_config(user_id)
+    return _update(user_id, (_SET_JIRA_BIT_SQL, (bit, bit if value else 0)))
 
-def set_jira_notification(user_id: int, event_type: str, value: bool) -> None:
-    cfg = get_user_config(user_id)
-    if event_type in cfg["notifications"]["jira"]:
-        cfg["notifications"]["jira"][event_type] = value
-        _save_cfg(user_id, cfg)
+
+def toggle_jira_notification(user_id: int, event_type: str) -> dict:
+    bit = JIRA_BITS.get(event_type)
+    if bit is None:
+        return get_user_config(user_id)
+    return _update(user_id, (_TOGGLE_JIRA_BIT_SQL, (bit,)))
 
 
 # ---- операции, используемые планировщиком ----------------------------------
@@ -156,22 +432,20 @@ def update_user_fields(user_id: int, **fields) -> None:
     Частичное обновление полей верхнего уровня конфига
     (например, last_uid или last_check_time).
     """
-    cfg = get_user_config(user_id)
-    cfg.update(fields)
-    _save_cfg(user_id, cfg)
+    unknown = set(fields) - set(_USER_FIELDS_SQL)
+    if unknown:
+        raise ValueError(f"Неизвестные поля конфига: {', '.join(sorted(unknown))}")
+    if not fields:
+        return
+    _update(
+        user_id,
+        *((_USER_FIELDS_SQL[name], (value,)) for name, value in fields.items()),
+    )
 
 
 def get_all_user_configs() -> list[tuple[int, dict]]:
     """[(user_id, cfg_dict), …] для всех пользователей."""
-    with _conn() as c:
-        rows = c.execute("SELECT user_id, cfg_json FROM user_configs").fetchall()
-    return [(int(uid), json.loads(cfg)) for uid, cfg in rows]
-
-
-# ---- совместимость со старым кодом ----------------------------------------
-def load_user_config():   # теперь просто no‑op
-    pass
-
+    with _read_conn() as c:
+        rows = c.execute(_LOAD_ALL_SQL).fetchall()
+    return [(int(row[0]), _row_to_cfg(row[1:])) for row in rows]
 
-def save_user_config():   # no‑op
-    pass
@@ -12,13 +12,16 @@ from telegram.ext import (
     filters,
 )
 import os
+import re
+from functools import lru_cache
 from urllib.parse import urlencode
 
 from config import (
     ensure_user_config,
     clear_email_credentials,
-    get_email_credentials,
-    set_jira_notification,
+    get_user_config,
+    toggle_jira_notification,
+    JIRA_BITS,
     toggle_mail_notifications,
     get_notifications_config,
     toggle_quiet_notifications,
@@ -31,6 +34,24 @@ YANDEX_CLIENT_ID = os.getenv("YANDEX_CLIENT_ID")
 REDIRECT_URI = os.getenv("YANDEX_REDIRECT_URI")
 SCOPE = "mail:imap_full login:email calendar:all"
 
+# Без этих переменных ссылка авторизации нерабочая — падаем сразу при старте,
+# а не на каждом нажатии «Добавить почту».
+if not YANDEX_CLIENT_ID or not REDIRECT_URI:
+    raise RuntimeError(
+        "Не заданы YANDEX_CLIENT_ID и/или YANDEX_REDIRECT_URI (см. .env)"
+    )
+
+_OAUTH_BASE_PARAMS = {
+    "response_type": "code",
+    "client_id": YANDEX_CLIENT_ID,
+    "redirect_uri": REDIRECT_URI,
+    "scope": SCOPE,
+}
+# Всё, кроме state (= user_id), постоянно — кодируем один раз.
+_AUTH_URL_PREFIX = (
+    f"https://oauth.yandex.ru/authorize?{urlencode(_OAUTH_BASE_PARAMS)}&state="
+)
+
 # --------------------------------------------------------------------------- #
 # Состояния                                                                    #
 # --------------------------------------------------------------------------- #
@@ -39,21 +60,19 @@ MAIN_MENU, CONFIRM_DELETE_EMAIL, SETTINGS_MENU, MAIL_MENU, JIRA_MENU = range(5)
 # --------------------------------------------------------------------------- #
 # Клавиатуры                                                                   #
 # --------------------------------------------------------------------------- #
-def main_menu_keyboard(user_id: int) -> InlineKeyboardMarkup:
-    """Показываем «Добавить почту» или «Настройки»."""
-    ensure_user_config(user_id)
-    email, token, _ = get_email_credentials(user_id)
+# InlineKeyboardMarkup неизменяем и зависит лишь от пары флагов, поэтому
+# разметка строится один раз на каждое сочетание флагов.
+@lru_cache(maxsize=None)
+def _main_kb(has_email: bool) -> InlineKeyboardMarkup:
     buttons = (
-        [[InlineKeyboardButton("Добавить почту", callback_data="add_email")]]
-        if not email or not token
-        else [[InlineKeyboardButton("Настройки", callback_data="settings")]]
+        [[InlineKeyboardButton("Настройки", callback_data="settings")]]
+        if has_email
+        else [[InlineKeyboardButton("Добавить почту", callback_data="add_email")]]
     )
     return InlineKeyboardMarkup(buttons)
 
 
-def settings_menu_keyboard(user_id: int) -> InlineKeyboardMarkup:
-    conf = get_notifications_config(user_id)
-    quiet_on = conf.get("quiet_notifications", True)
+def _build_settings_kb(quiet_on: bool) -> InlineKeyboardMarkup:
     quiet_label = f"Уведомлять только в рабочее время [{'ДА' if quiet_on else 'НЕТ'}]"
     buttons = [
         [InlineKeyboardButton("Почта", callback_data="mail_menu")],
@@ -63,18 +82,63 @@ def settings_menu_keyboard(user_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(buttons)
 
 
-def mail_menu_keyboard(user_id: int) -> InlineKeyboardMarkup:
-    email_value, token, _ = get_email_credentials(user_id)
-    email_set = bool(email_value and token)
-    conf = get_notifications_config(user_id)
+# Вариантов всего два — оба строятся при импорте.
+_SETTINGS_MARKUPS = {quiet_on: _build_settings_kb(quiet_on) for quiet_on in (False, True)}
+
+
+# Кнопки Jira‑меню: для каждого типа события по варианту (выкл, вкл) —
+# меню для любой маски собирается из готовых кнопок.
+_JIRA_BUTTONS = {
+    e_type: tuple(
+        InlineKeyboardButton(
+            f"{e_type} [{'ДА' if on else 'НЕТ'}]",
+            callback_data=f"toggle_jira_{e_type}",
+        )
+        for on in (False, True)
+    )
+    for e_type in JIRA_BITS
+}
+_JIRA_BACK_ROW = (InlineKeyboardButton("Назад", callback_data="back_to_mail_menu"),)
+
+
+@lru_cache(maxsize=None)
+def _jira_kb(jira_mask: int) -> InlineKeyboardMarkup:
+    rows = [
+        (_JIRA_BUTTONS[e_type][bool(jira_mask & bit)],)
+        for e_type, bit in JIRA_BITS.items()
+    ]
+    rows.append(_JIRA_BACK_ROW)
+    return InlineKeyboardMarkup(rows)
+
+
+# *_markup(cfg) рисуют меню по уже известному конфигу (например, вернувшемуся
+# из мутатора), *_keyboard(user_id) — сначала читают его.
+def _main_markup(cfg: dict) -> InlineKeyboardMarkup:
+    """Показываем «Добавить почту» или «Настройки»."""
+    return _main_kb(bool(cfg["email"]["value"] and cfg["email"]["password"]))
+
+
+def _settings_markup(cfg: dict) -> InlineKeyboardMarkup:
+    quiet_on = cfg["notifications"].get("quiet_notifications", True)
+    return _SETTINGS_MARKUPS[bool(quiet_on)]
+
+
+def main_menu_keyboard(user_id: int) -> InlineKeyboardMarkup:
+    return _main_markup(get_user_config(user_id))
+
+
+def settings_menu_keyboard(user_id: int) -> InlineKeyboardMarkup:
+    return _settings_markup(get_user_config(user_id))
 
+
+@lru_cache(maxsize=None)
+def _mail_kb(email_set: bool, mail_on: bool) -> InlineKeyboardMarkup:
     buttons = []
     if email_set:
         buttons.append([InlineKeyboardButton("Удалить", callback_data="delete_email")])
 
     buttons.append([InlineKeyboardButton("Уведомления Jira", callback_data="jira_menu")])
 
-    mail_on = conf["mail"]
     mail_label = "Уведомления о письмах [ДА]" if mail_on else "Уведомления о письмах [НЕТ]"
     buttons.append([InlineKeyboardButton(mail_label, callback_data="toggle_mail_notifications")])
 
@@ -82,31 +146,28 @@ def mail_menu_keyboard(user_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(buttons)
 
 
-def confirm_delete_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        [
-            [
-                InlineKeyboardButton("Да", callback_data="delete_yes"),
-                InlineKeyboardButton("Нет", callback_data="delete_no"),
-            ]
-        ]
-    )
+def _mail_markup(cfg: dict) -> InlineKeyboardMarkup:
+    email_set = bool(cfg["email"]["value"] and cfg["email"]["password"])
+    return _mail_kb(email_set, cfg["notifications"]["mail"])
 
 
-def jira_menu_keyboard(user_id: int) -> InlineKeyboardMarkup:
-    conf = get_notifications_config(user_id)
-    jira_conf = conf["jira"]
-    rows = [
+def mail_menu_keyboard(user_id: int) -> InlineKeyboardMarkup:
+    return _mail_markup(get_user_config(user_id))
+
+
+# Не зависит от пользователя — строится один раз при импорте.
+CONFIRM_DELETE_MARKUP = InlineKeyboardMarkup(
+    [
         [
-            InlineKeyboardButton(
-                f"{e_type} [{'ДА' if value else 'НЕТ'}]",
-                callback_data=f"toggle_jira_{e_type}",
-            )
+            InlineKeyboardButton("Да", callback_data="delete_yes"),
+            InlineKeyboardButton("Нет", callback_data="delete_no"),
         ]
-        for e_type, value in jira_conf.items()
     ]
-    rows.append([InlineKeyboardButton("Назад", callback_data="back_to_mail_menu")])
-    return InlineKeyboardMarkup(rows)
+)
+
+
+def jira_menu_keyboard(user_id: int) -> InlineKeyboardMarkup:
+    return _jira_kb(get_notifications_config(user_id)["jira"])
 
 # --------------------------------------------------------------------------- #
 # Хэндлеры меню                                                                #
@@ -123,164 +184,189 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return MAIN_MENU
 
 
-async def main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка нажатий в главном меню."""
-    query = update.callback_query
-    user_id = query.from_user.id
-    await query.answer()
-    data = query.data
-
-    # «Добавить почту» → выдаём ссылку OAuth
-    if data == "add_email":
-        params = {
-            "response_type": "code",
-            "client_id": YANDEX_CLIENT_ID,
-            "redirect_uri": REDIRECT_URI,
-            "scope": SCOPE,
-            "state": str(user_id),
-        }
-        auth_link = f"https://oauth.yandex.ru/authorize?{urlencode(params)}"
-        keyboard = InlineKeyboardMarkup(
-            [
-                [InlineKeyboardButton("Авторизоваться через Яндекс", url=auth_link)],
-                [InlineKeyboardButton("Назад", callback_data="back_to_main")],
-            ]
-        )
-        await query.edit_message_text(
-            (
-                "⚡ *Шаг 1.* Нажмите кнопку ниже и перейдите по ссылке.\n"
-                "⚡ *Шаг 2.* Авторизуйтесь на сайте и вернитесь в чат."
-            ),
-            parse_mode="Markdown",
-            reply_markup=keyboard,
-            disable_web_page_preview=True,
-        )
-        return MAIN_MENU
-
-    # «Настройки»
-    elif data == "settings":
-        await query.edit_message_text(
-            "Открываю настройки...", reply_markup=settings_menu_keyboard(user_id)
-        )
-        return SETTINGS_MENU
+# ---- действия по кнопкам: (query, user_id) -> следующее состояние ----------
+async def _show_add_email(query, user_id: int):
+    """«Добавить почту» → выдаём ссылку OAuth."""
+    auth_link = f"{_AUTH_URL_PREFIX}{user_id}"
+    keyboard = InlineKeyboardMarkup(
+        [
+            [InlineKeyboardButton("Авторизоваться через Яндекс", url=auth_link)],
+            [InlineKeyboardButton("Назад", callback_data="back_to_main")],
+        ]
+    )
+    await query.edit_message_text(
+        (
+            "⚡ *Шаг 1.* Нажмите кнопку ниже и перейдите по ссылке.\n"
+            "⚡ *Шаг 2.* Авторизуйтесь на сайте и вернитесь в чат."
+        ),
+        parse_mode="Markdown",
+        reply_markup=keyboard,
+        disable_web_page_preview=True,
+    )
+    return MAIN_MENU
 
-    # «Назад» из любого места
-    elif data == "back_to_main":
-        await query.edit_message_text(
-            "Главное меню", reply_markup=main_menu_keyboard(user_id)
-        )
-        return MAIN_MENU
 
+async def _show_main_menu(query, user_id: int):
+    await query.edit_message_text(
+        "Главное меню", reply_markup=main_menu_keyboard(user_id)
+    )
     return MAIN_MENU
 
 
-async def settings_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    user_id = query.from_user.id
-    await query.answer()
-    data = query.data
+async def _open_settings(query, user_id: int):
+    await query.edit_message_text(
+        "Открываю настройки...", reply_markup=settings_menu_keyboard(user_id)
+    )
+    return SETTINGS_MENU
 
-    if data == "mail_menu":
-        await query.edit_message_text(
-            "Настройки почты", reply_markup=mail_menu_keyboard(user_id)
-        )
-        return MAIL_MENU
 
-    elif data == "back_to_main":
-        await query.edit_message_text(
-            "Главное меню", reply_markup=main_menu_keyboard(user_id)
-        )
-        return MAIN_MENU
-
-    elif data == "toggle_quiet_notifications":
-        toggle_quiet_notifications(user_id)
-        conf = get_notifications_config(user_id)
-        status = "ДА" if conf["quiet_notifications"] else "НЕТ"
-        await query.edit_message_text(
-            f"Тихие сообщения вне рабочего времени теперь: {status}",
-            reply_markup=settings_menu_keyboard(user_id),
-        )
-        return SETTINGS_MENU
+async def _show_settings(query, user_id: int):
+    await query.edit_message_text(
+        "Настройки", reply_markup=settings_menu_keyboard(user_id)
+    )
+    return SETTINGS_MENU
 
 
-async def mail_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    user_id = query.from_user.id
-    await query.answer()
-    data = query.data
+async def _toggle_quiet(query, user_id: int):
+    cfg = toggle_quiet_notifications(user_id)
+    status = "ДА" if cfg["notifications"]["quiet_notifications"] else "НЕТ"
+    await query.edit_message_text(
+        f"Тихие сообщения вне рабочего времени теперь: {status}",
+        reply_markup=_settings_markup(cfg),
+    )
+    return SETTINGS_MENU
 
-    if data == "delete_email":
-        await query.edit_message_text(
-            "Вы действительно хотите удалить почту?",
-            reply_markup=confirm_delete_keyboard(),
-        )
-        return CONFIRM_DELETE_EMAIL
-
-    elif data == "toggle_mail_notifications":
-        toggle_mail_notifications(user_id)
-        conf = get_notifications_config(user_id)
-        status = "ДА" if conf["mail"] else "НЕТ"
-        await query.edit_message_text(
-            f"Уведомления о письмах теперь: {status}",
-            reply_markup=mail_menu_keyboard(user_id),
-        )
-        return MAIL_MENU
 
-    elif data == "jira_menu":
-        await query.edit_message_text(
-            "Настройки Jira‑уведомлений", reply_markup=jira_menu_keyboard(user_id)
-        )
-        return JIRA_MENU
+async def _show_mail_menu(query, user_id: int):
+    await query.edit_message_text(
+        "Настройки почты", reply_markup=mail_menu_keyboard(user_id)
+    )
+    return MAIL_MENU
 
-    elif data == "back_to_settings":
-        await query.edit_message_text(
-            "Настройки", reply_markup=settings_menu_keyboard(user_id)
-        )
-        return SETTINGS_MENU
+
+async def _ask_delete_email(query, user_id: int):
+    await query.edit_message_text(
+        "Вы действительно хотите удалить почту?",
+        reply_markup=CONFIRM_DELETE_MARKUP,
+    )
+    return CONFIRM_DELETE_EMAIL
 
 
-async def confirm_delete_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def _toggle_mail(query, user_id: int):
+    cfg = toggle_mail_notifications(user_id)
+    status = "ДА" if cfg["notifications"]["mail"] else "НЕТ"
+    await query.edit_message_text(
+        f"Уведомления о письмах теперь: {status}",
+        reply_markup=_mail_markup(cfg),
+    )
+    return MAIL_MENU
+
+
+async def _show_jira_menu(query, user_id: int):
+    await query.edit_message_text(
+        "Настройки Jira‑уведомлений", reply_markup=jira_menu_keyboard(user_id)
+    )
+    return JIRA_MENU
+
+
+async def _delete_email(query, user_id: int):
+    cfg = clear_email_credentials(user_id)
+    await query.edit_message_text(
+        "Почта удалена!", reply_markup=_main_markup(cfg)
+    )
+    return MAIN_MENU
+
+
+async def _cancel_delete_email(query, user_id: int):
+    await query.edit_message_text(
+        "Отмена удаления.", reply_markup=mail_menu_keyboard(user_id)
+    )
+    return MAIL_MENU
+
+
+# ---- таблицы callback_data → действие для каждого состояния ---------------
+_MAIN_MENU_ACTIONS = {
+    "add_email": _show_add_email,
+    "settings": _open_settings,
+    "back_to_main": _show_main_menu,
+}
+_SETTINGS_MENU_ACTIONS = {
+    "mail_menu": _show_mail_menu,
+    "back_to_main": _show_main_menu,
+    "toggle_quiet_notifications": _toggle_quiet,
+}
+_MAIL_MENU_ACTIONS = {
+    "delete_email": _ask_delete_email,
+    "toggle_mail_notifications": _toggle_mail,
+    "jira_menu": _show_jira_menu,
+    "back_to_settings": _show_settings,
+}
+_CONFIRM_DELETE_ACTIONS = {
+    "delete_yes": _delete_email,
+    "delete_no": _cancel_delete_email,
+}
+_JIRA_MENU_ACTIONS = {
+    "back_to_mail_menu": _show_mail_menu,
+}
+
+TOGGLE_JIRA_PATTERN = re.compile(r"^toggle_jira_(\w+)$")
+
+
+# Нажатия «мёртвых» кнопок (из старых сообщений/чужого состояния) клиент
+# Telegram кэширует на это время и повторно не присылает. Рабочим кнопкам
+# кэш не ставим: повторное нажатие тумблера должно доходить до бота.
+_STALE_CALLBACK_CACHE_TIME = 5
+
+
+async def _dispatch(update: Update, actions: dict, default=None):
+    """Отвечает на callback и вызывает действие по query.data."""
     query = update.callback_query
-    user_id = query.from_user.id
+    action = actions.get(query.data)
+    if action is None:
+        await query.answer(cache_time=_STALE_CALLBACK_CACHE_TIME)
+        return default
     await query.answer()
-    data = query.data
+    return await action(query, query.from_user.id)
 
-    if data == "delete_yes":
-        clear_email_credentials(user_id)
-        await query.edit_message_text(
-            "Почта удалена!", reply_markup=main_menu_keyboard(user_id)
-        )
-        return MAIN_MENU
-    elif data == "delete_no":
-        await query.edit_message_text(
-            "Отмена удаления.", reply_markup=mail_menu_keyboard(user_id)
-        )
-        return MAIL_MENU
+
+async def main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка нажатий в главном меню."""
+    return await _dispatch(update, _MAIN_MENU_ACTIONS, default=MAIN_MENU)
+
+
+async def settings_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await _dispatch(update, _SETTINGS_MENU_ACTIONS)
+
+
+async def mail_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await _dispatch(update, _MAIL_MENU_ACTIONS)
+
+
+async def confirm_delete_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await _dispatch(update, _CONFIRM_DELETE_ACTIONS)
 
 
 async def jira_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await _dispatch(update, _JIRA_MENU_ACTIONS)
+
+
+async def jira_toggle_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """toggle_jira_<тип>: тип события приходит группой из TOGGLE_JIRA_PATTERN."""
     query = update.callback_query
     user_id = query.from_user.id
     await query.answer()
-    data = query.data
-
-    if data == "back_to_mail_menu":
-        await query.edit_message_text(
-            "Настройки почты", reply_markup=mail_menu_keyboard(user_id)
-        )
-        return MAIL_MENU
-
-    if data.startswith("toggle_jira_"):
-        e_type = data.replace("toggle_jira_", "")
-        conf = get_notifications_config(user_id)
-        current_val = conf["jira"].get(e_type, False)
-        set_jira_notification(user_id, e_type, not current_val)
 
-        await query.edit_message_text(
-            f"Переключили '{e_type}' -> {not current_val}",
-            reply_markup=jira_menu_keyboard(user_id),
-        )
+    e_type = context.match.group(1)
+    if e_type not in JIRA_BITS:
         return JIRA_MENU
+    jira_mask = toggle_jira_notification(user_id, e_type)["notifications"]["jira"]
+    new_val = bool(jira_mask & JIRA_BITS[e_type])
+
+    await query.edit_message_text(
+        f"Переключили '{e_type}' -> {new_val}",
+        reply_markup=_jira_kb(jira_mask),
+    )
+    return JIRA_MENU
 
 
 async def fallback_to_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -300,26 +386,27 @@ def build_conversation_handler() -> ConversationHandler:
         states={
             MAIN_MENU: [
                 CallbackQueryHandler(main_menu_handler),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, fallback_to_main_menu),
             ],
             SETTINGS_MENU: [
                 CallbackQueryHandler(settings_menu_handler),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, fallback_to_main_menu),
             ],
             MAIL_MENU: [
                 CallbackQueryHandler(mail_menu_handler),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, fallback_to_main_menu),
             ],
             CONFIRM_DELETE_EMAIL: [
                 CallbackQueryHandler(confirm_delete_handler),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, fallback_to_main_menu),
             ],
             JIRA_MENU: [
+                CallbackQueryHandler(jira_toggle_handler, pattern=TOGGLE_JIRA_PATTERN),
                 CallbackQueryHandler(jira_menu_handler),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, fallback_to_main_menu),
             ],
         },
-        fallbacks=[CommandHandler("start", cmd_start)],
+        # Текст в любом состоянии меню → возврат в главное меню; одна запись
+        # в fallbacks вместо копии в каждом состоянии.
+        fallbacks=[
+            CommandHandler("start", cmd_start),
+            MessageHandler(filters.TEXT & ~filters.COMMAND, fallback_to_main_menu),
+        ],
         per_message=False,
         per_chat=True,
     )
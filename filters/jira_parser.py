@@ -1,7 +1,9 @@
 import re
+import hashlib
 import logging
-from bs4 import BeautifulSoup
-from collections import defaultdict
+import threading
+from bs4 import BeautifulSoup, SoupStrainer
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
@@ -21,9 +23,49 @@ HEADER_PATTERNS = {
     }
 }
 
+# Все фразы HEADER_PATTERNS одним регэкспом: header-history сканируется за один проход
+_HEADER_PHRASE_EVENTS = {
+    pattern: event_type
+    for event_type, patterns in HEADER_PATTERNS.items()
+    for pattern in patterns.values()
+}
+_HEADER_PHRASE_RE = re.compile("|".join(map(re.escape, _HEADER_PHRASE_EVENTS)))
+
+# Тип события по классу таблицы группы: <table class="group comments-group">, …
+EVENT_TYPE_BY_GROUP_CLASS = {
+    "comments-group": "comment",
+    "updates-group": "update",
+    "new-issue-group": "created",
+    "worklogs-group": "worklog",
+}
+
+
+class _JiraTablesStrainer(SoupStrainer):
+    """Строит в дереве только table#header-history и table.structure со всем содержимым."""
+
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        return name == "table" and (
+            attrs.get("id") == "header-history"
+            or "structure" in attrs.get("class", "").split()
+        )
+
+
+_JIRA_TABLES = _JiraTablesStrainer()
+
+# Кэш результатов разбора: Jira часто присылает одно и то же письмо повторно
+# (пересылка, несколько получателей), ключ — короткий хэш HTML
+_PARSE_CACHE_SIZE = 512
+_parse_cache = OrderedDict()
+_PARSE_CACHE_LOCK = threading.Lock()  # парсер вызывается из потоков asyncio.to_thread
+
+
 def parse_jira_email(email_content):
     """
     Парсит письмо от Jira и извлекает информацию о событиях.
+
+    События — кортеж пар (автор, тип) всех типов; автор None у событий из
+    header-history. Фильтр по настройкам пользователя — на вызывающем.
+    Результат кэшируется и общий для одинаковых писем: вызывающий его не изменяет.
     """
     if not email_content:
         return None
@@ -32,18 +74,32 @@ def parse_jira_email(email_content):
     if '<body class="jira"' not in email_content:
         return None
 
+    key = hashlib.blake2b(email_content.encode(), digest_size=16).digest()
+    with _PARSE_CACHE_LOCK:
+        if key in _parse_cache:
+            _parse_cache.move_to_end(key)
+            return _parse_cache[key]
+
+    result = _parse_jira_html(email_content)
+    with _PARSE_CACHE_LOCK:
+        _parse_cache[key] = result
+        if len(_parse_cache) > _PARSE_CACHE_SIZE:
+            _parse_cache.popitem(last=False)
+    return result
+
+
+def _parse_jira_html(email_content):
+    """Полный разбор HTML письма Jira (без кэша)."""
     try:
-        soup = BeautifulSoup(email_content, 'html.parser')
-        text_content = soup.get_text()
+        soup = BeautifulSoup(email_content, 'lxml', parse_only=_JIRA_TABLES)
 
         # 1. Парсим header-history для событий assigned, mention_description, mention_comment
         header_events = []
         header_history = soup.find("table", id="header-history")
         if header_history:
             header_text = header_history.get_text(separator=" ", strip=True)
-            for event_type, patterns in HEADER_PATTERNS.items():
-                if any(pattern in header_text for pattern in patterns.values()):
-                    header_events.append({"type": event_type})
+            found = {_HEADER_PHRASE_EVENTS[m.group()] for m in _HEADER_PHRASE_RE.finditer(header_text)}
+            header_events = [event_type for event_type in HEADER_PATTERNS if event_type in found]
 
         # 2. Парсим structure для основной информации и событий
         structure = soup.find("table", class_="structure")
@@ -79,23 +135,18 @@ def parse_jira_email(email_content):
         summary = summary_h1.get_text(strip=True)
 
         # 2.2 Парсим события
-        author_events = defaultdict(list)
+        events = []
         
         # Ищем все группы событий
-        event_groups = structure.find_all("table", class_=re.compile(r"group (comments|updates|new-issue|worklogs)-group"))
+        event_groups = structure.find_all("table", class_="group")
         
         for group in event_groups:
             # Определяем тип события по классу группы
-            group_class = group["class"][1]
-            if "comments" in group_class:
-                event_type = "comment"
-            elif "updates" in group_class:
-                event_type = "update"
-            elif "new-issue" in group_class:
-                event_type = "created"
-            elif "worklogs" in group_class:
-                event_type = "worklog"
-            else:
+            event_type = next(
+                (EVENT_TYPE_BY_GROUP_CLASS[c] for c in group["class"] if c in EVENT_TYPE_BY_GROUP_CLASS),
+                None,
+            )
+            if event_type is None:
                 continue
 
             # Ищем автора события
@@ -114,22 +165,21 @@ def parse_jira_email(email_content):
             author = author_strong.get_text(strip=True)
             
             # Добавляем событие
-            author_events[author].append({"type": event_type})
+            events.append((author, event_type))
 
         # Добавляем события из header-history
-        for event in header_events:
-            author_events[None].append(event)
+        events.extend((None, event_type) for event_type in header_events)
 
-        if not author_events:
+        if not events:
             return None
 
         return {
             'task_key': issue_key,
             'task_summary': summary,
             'task_url': issue_url,
-            'author_events': dict(author_events)
+            'events': tuple(events)
         }
 
     except Exception as e:
-        logger.error(f"Error parsing Jira email: {str(e)}")
+        logger.error("Error parsing Jira email: %s", e)
         return None
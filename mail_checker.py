@@ -1,15 +1,54 @@
 import asyncio
+import binascii
 import logging
+import os
+import quopri
+from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from email import policy
-from email.parser import BytesParser
+from email.parser import BytesHeaderParser
 
 from imapclient import IMAPClient
+from imapclient.response_types import BodyData
 
 import config
 from filters.jira_parser import parse_jira_email
 from telegram.helpers import escape_markdown
 
+logger = logging.getLogger(__name__)
+
+# Сигнатура HTML‑писем Jira (та же, что проверяет parse_jira_email)
+_JIRA_BODY_MARKER = b'<body class="jira"'
+
+# Парсер заголовков без состояния: один на модуль (безопасен для потоков to_thread)
+_HEADER_PARSER = BytesHeaderParser(policy=policy.default)
+
+# Таймаут сокета IMAP, с: полуоткрытое соединение из пула (NAT/сервер молча
+# закрыл его между проходами) иначе висит до ретрансмит‑таймаута ядра (~15 мин)
+# и задерживает проход для всех пользователей
+_IMAP_TIMEOUT = 30
+
+# Сколько писем запрашивать одним IMAP FETCH
+_FETCH_BATCH_SIZE = 100
+
+# Сколько пользователей проверяем одновременно (IMAP‑соединения и потоки to_thread)
+MAIL_CONCURRENCY = int(os.getenv("MAIL_CONCURRENCY", "16"))
+
+# Строки уведомления по типам Jira‑событий, в порядке вывода
+_EVENT_LINES = tuple(
+    (config.JIRA_BITS[event_type], text)
+    for event_type, text in (
+        ("assigned", "✅ назначил(а) вас исполнителем задачи"),
+        ("created", "📌 создал(а) задачу"),
+        ("update", "✏️ внес(ла) изменения"),
+        ("comment", "💬 оставил(а) комментарий"),
+        ("mention_description", "👀 упомянул(а) вас в задаче"),
+        ("mention_comment", "👀 упомянул(а) вас в комментариях"),
+        ("worklog", "⏱️ трекнул(а) время"),
+    )
+)
+
 
 # ────────────────────────  ⚡ Быстрая UID‑закладка  ─────────────────────────
 async def bookmark_latest_uid(
@@ -25,7 +64,7 @@ async def bookmark_latest_uid(
     """
 
     def _get_highest_uid() -> int:
-        with IMAPClient(host, ssl=True) as c:
+        with IMAPClient(host, ssl=True, timeout=_IMAP_TIMEOUT) as c:
             c.oauth2_login(email, token)
             c.select_folder("INBOX", readonly=True)
             uids = c.search(["ALL"])
@@ -33,30 +72,38 @@ async def bookmark_latest_uid(
 
     highest_uid = await asyncio.to_thread(_get_highest_uid)
 
-    config.update_user_fields(
+    # запись в SQLite может ждать _WRITER_LOCK — не на event loop
+    await asyncio.to_thread(
+        config.update_user_fields,
         user_id,
         last_uid=highest_uid,
-        last_check_time=datetime.now().isoformat(),
+        last_check_time=config.now_iso(),
     )
 
-    logging.info(f"[{user_id}] UID‑закладка выполнена ⇒ {highest_uid}")
+    logger.info("[%s] UID‑закладка выполнена ⇒ %s", user_id, highest_uid)
 
 
 # ───────────────────  Основная проверка почты ───────────────────────────────
 async def check_mail_for_all_users(app):
-    logging.info("=== Проверка почты для всех пользователей ===")
+    logger.info("=== Проверка почты для всех пользователей ===")
 
     # Берём актуальные данные прямо из SQLite
     all_users = config.get_all_user_configs()
 
+    semaphore = asyncio.Semaphore(MAIL_CONCURRENCY)
+
+    async def _bounded_check(uid, cfg):
+        async with semaphore:
+            await check_and_notify(app, uid, cfg)
+
     tasks = [
-        asyncio.create_task(check_and_notify(app, uid, cfg))
+        asyncio.create_task(_bounded_check(uid, cfg))
         for uid, cfg in all_users
     ]
     if tasks:
         await asyncio.gather(*tasks)
 
-    logging.info("=== Завершён проход проверки почты ===")
+    logger.info("=== Завершён проход проверки почты ===")
 
 
 async def retry_imap_connect(func, max_retries=3, delay=5):
@@ -67,24 +114,138 @@ async def retry_imap_connect(func, max_retries=3, delay=5):
         except Exception as e:
             if attempt == max_retries - 1:  # последняя попытка
                 raise
-            logging.warning(f"Попытка {attempt + 1}/{max_retries} не удалась: {e}")
+            logger.warning("Попытка %s/%s не удалась: %s", attempt + 1, max_retries, e)
             await asyncio.sleep(delay)
 
 
+# ─────────────────  Переиспользуемые IMAP‑соединения  ───────────────────────
+# user_id → ((host, email, token), IMAPClient с выбранным INBOX)
+_IMAP_CLIENTS = {}
+
+
+def _close_imap(client) -> None:
+    try:
+        client.shutdown()
+    except Exception:
+        pass
+
+
+def _imap_alive(client) -> bool:
+    try:
+        client.noop()
+        return True
+    except Exception:
+        # в т.ч. socket.timeout от полуоткрытого соединения — сессия мёртвая
+        return False
+
+
+def _drop_imap(user_id) -> None:
+    cached = _IMAP_CLIENTS.pop(user_id, None)
+    if cached is not None:
+        _close_imap(cached[1])
+
+
+@contextmanager
+def _imap_session(user_id, host, email, token):
+    """
+    Открытый (readonly) INBOX пользователя без повторного TLS и логина на каждом проходе.
+    Соединение забирается из пула на время работы и возвращается только после успеха;
+    мёртвое (NOOP не прошёл) или со сменившимися учётными данными пересоздаётся.
+    """
+    creds = (host, email, token)
+    client = None
+    cached = _IMAP_CLIENTS.pop(user_id, None)
+    if cached is not None:
+        cached_creds, cached_client = cached
+        if cached_creds == creds and _imap_alive(cached_client):
+            client = cached_client
+        else:
+            _close_imap(cached_client)
+
+    if client is None:
+        client = IMAPClient(host, ssl=True, timeout=_IMAP_TIMEOUT)
+        try:
+            client.oauth2_login(email, token)
+            client.select_folder("INBOX", readonly=True)
+        except BaseException:
+            _close_imap(client)
+            raise
+
+    try:
+        yield client
+    except BaseException:
+        _close_imap(client)
+        raise
+    # При MAX_INSTANCES > 1 параллельный проход мог уже вернуть своё соединение
+    if _IMAP_CLIENTS.setdefault(user_id, (creds, client))[1] is not client:
+        _close_imap(client)
+
+
+def close_imap_connections() -> None:
+    """Закрывает все сохранённые IMAP‑соединения (при остановке бота)."""
+    for user_id in list(_IMAP_CLIENTS):
+        _drop_imap(user_id)
+
+
+def _parse_headers(raw_headers: bytes):
+    """Возвращает (тема, отправитель) по заголовкам письма."""
+    msg = _HEADER_PARSER.parsebytes(raw_headers)
+    return msg["subject"] or "(без темы)", msg["from"] or "(неизвестно)"
+
+
+def _find_html_part(structure, path=()):
+    """
+    Ищет в BODYSTRUCTURE первую text/html часть (в том же порядке, что msg.walk,
+    включая вложенные message/rfc822 — например, пересланное письмо Jira).
+    Возвращает (номер секции, Content-Transfer-Encoding, charset) или None.
+    """
+    if structure.is_multipart:
+        for number, part in enumerate(structure[0], 1):
+            found = _find_html_part(part, path + (number,))
+            if found is not None:
+                return found
+        return None
+    if structure[0].lower() == b"message" and structure[1].lower() == b"rfc822":
+        # [8] — тело вложенного письма; imapclient оставляет его сырым кортежем.
+        # Части multipart внутри нумеруются N.1, N.2…, одиночное тело — N.1
+        own = path or (1,)
+        nested = BodyData.create(structure[8])
+        return _find_html_part(nested, own if nested.is_multipart else own + (1,))
+    if structure[0].lower() != b"text" or structure[1].lower() != b"html":
+        return None
+    params = structure[2] or ()
+    charset = dict(zip((p.lower() for p in params[::2]), params[1::2])).get(b"charset")
+    section = ".".join(map(str, path or (1,)))
+    return section, (structure[5] or b"").lower(), charset.decode() if charset else None
+
+
+def _decode_html(payload: bytes, encoding: bytes, charset):
+    """Декодирует HTML‑часть; HTML нужен только парсеру Jira, остальные письма — ""."""
+    if encoding == b"base64":
+        payload = binascii.a2b_base64(payload)
+    elif encoding == b"quoted-printable":
+        payload = quopri.decodestring(payload)
+    if _JIRA_BODY_MARKER not in payload:
+        return ""
+    return payload.decode(charset or "utf-8", errors="replace")
+
+
 async def check_and_notify(app, user_id: int, cfg: dict):
     email_value = cfg["email"]["value"]
     token = cfg["email"]["password"]
     host = cfg["email"]["host"]
     if not email_value or not token:
-        logging.info(f"[{user_id}] Пропускаем проверку: отсутствуют учетные данные почты")
+        logger.info("[%s] Пропускаем проверку: отсутствуют учетные данные почты", user_id)
+        _drop_imap(user_id)
         return
 
-    logging.info(f"[{user_id}] Проверяем почту {email_value}")
+    logger.info("[%s] Проверяем почту %s", user_id, email_value)
 
     # --- диапазон времени ----------------------------------------------------
     now_dt = datetime.now()
-    last_check_time = datetime.fromisoformat(
-        cfg.get("last_check_time", now_dt.isoformat())
+    stored_check_time = cfg.get("last_check_time")
+    last_check_time = (
+        datetime.fromisoformat(stored_check_time) if stored_check_time else now_dt
     )
 
     if (now_dt - last_check_time) > timedelta(minutes=15):
@@ -93,69 +254,84 @@ async def check_and_notify(app, user_id: int, cfg: dict):
     since_str = last_check_time.strftime("%d-%b-%Y")
     last_uid = cfg.get("last_uid")
 
+    # --- «тихие часы» --------------------------------------------------------
+    def quiet_time() -> bool:
+        msk = datetime.utcnow() + timedelta(hours=3)
+        return not (0 <= msk.weekday() <= 4 and 9 <= msk.hour < 18)
+
+    # --- настройки пользователя не меняются в пределах прохода ---------------
+    notifications = cfg["notifications"]
+    mail_enabled = notifications["mail"]
+    mute = notifications.get("quiet_notifications", True) and quiet_time()
+    jira_mask = notifications["jira"]
+
     # --- получаем письма -----------------------------------------------------
     def fetch_new():
         res = []
         try:
-            with IMAPClient(host, ssl=True) as c:
-                c.oauth2_login(email_value, token)
-                c.select_folder("INBOX", readonly=True)
-                for uid in c.search(["SINCE", since_str]):
-                    if last_uid and uid <= last_uid:
-                        continue
-                    data = c.fetch([uid], ["BODY[]", "INTERNALDATE"])[uid]
-                    if data[b"INTERNALDATE"].replace(tzinfo=None) <= last_check_time:
-                        continue
-                    raw_data = data[b"BODY[]"]
-                    msg = BytesParser(policy=policy.default).parsebytes(raw_data)
-                    subject = msg["subject"] or "(без темы)"
-                    sender = msg["from"] or "(неизвестно)"
-                    html = ""
-                    if msg.is_multipart():
-                        for part in msg.walk():
-                            if part.get_content_type() == "text/html":
-                                html = part.get_payload(decode=True).decode(
-                                    part.get_content_charset() or "utf-8",
-                                    errors="replace",
-                                )
-                                break
-                    elif msg.get_content_type() == "text/html":
-                        html = msg.get_payload(decode=True).decode(
-                            msg.get_content_charset() or "utf-8",
-                            errors="replace",
-                        )
-                    res.append((uid, subject, sender, html))
+            with _imap_session(user_id, host, email_value, token) as c:
+                criteria = ["SINCE", since_str]
+                if last_uid:
+                    # Сервер сразу отдаёт только UID после закладки
+                    criteria += ["UID", f"{last_uid + 1}:*"]
+                # «N:*» всегда включает последний UID, даже если он меньше N
+                uids = [uid for uid in c.search(criteria) if not last_uid or uid > last_uid]
+                # Забираем письма пачками: один FETCH на пачку, а не на каждый UID.
+                # Целиком письмо не качаем: заголовки + структура, затем только HTML‑часть
+                for start in range(0, len(uids), _FETCH_BATCH_SIZE):
+                    batch = uids[start:start + _FETCH_BATCH_SIZE]
+                    fetched = c.fetch(batch, ["BODYSTRUCTURE", "BODY.PEEK[HEADER]", "INTERNALDATE"])
+                    messages = {}
+                    html_sections = defaultdict(list)
+                    for uid in batch:
+                        data = fetched.get(uid)
+                        if data is None:
+                            continue
+                        if data[b"INTERNALDATE"].replace(tzinfo=None) <= last_check_time:
+                            continue
+                        messages[uid] = [data[b"BODY[HEADER]"], ""]
+                        html_part = _find_html_part(data[b"BODYSTRUCTURE"])
+                        if html_part is not None:
+                            section, encoding, charset = html_part
+                            html_sections[section].append((uid, encoding, charset))
+                    for section, parts in html_sections.items():
+                        bodies = c.fetch([uid for uid, _, _ in parts], [f"BODY.PEEK[{section}]"])
+                        key = f"BODY[{section}]".encode()
+                        for uid, encoding, charset in parts:
+                            messages[uid][1] = _decode_html(bodies[uid][key], encoding, charset)
+                    for uid, (raw_headers, html) in messages.items():
+                        # Тема и отправитель нужны только Jira‑письмам и обычным
+                        # уведомлениям; при выключенной почте остальное не разбираем
+                        if html or mail_enabled:
+                            res.append((uid, *_parse_headers(raw_headers), html))
+                        else:
+                            res.append((uid, None, None, html))
         except Exception as e:
-            logging.error(f"[{user_id}] IMAP/XOAUTH2 ошибка: {e}")
+            logger.error("[%s] IMAP/XOAUTH2 ошибка: %s", user_id, e)
         return res
 
     try:
         new_messages = await retry_imap_connect(fetch_new)
     except Exception as e:
-        logging.error(f"[{user_id}] Все попытки подключения к IMAP не удались: {e}")
+        logger.error("[%s] Все попытки подключения к IMAP не удались: %s", user_id, e)
         return
 
     if not new_messages:
-        logging.info(f"[{user_id}] Новые письма не найдены")
+        logger.info("[%s] Новые письма не найдены", user_id)
         return
 
-    logging.info(f"[{user_id}] Найдено {len(new_messages)} новых писем")
-
-    # --- «тихие часы» --------------------------------------------------------
-    def quiet_time() -> bool:
-        msk = datetime.utcnow() + timedelta(hours=3)
-        return not (0 <= msk.weekday() <= 4 and 9 <= msk.hour < 18)
+    logger.info("[%s] Найдено %s новых писем", user_id, len(new_messages))
 
     # --- рассылаем уведомления ----------------------------------------------
     last_processed_uid = last_uid
     for uid, subject, sender, html in new_messages:
-        allowed = {k for k, v in cfg["notifications"]["jira"].items() if v}
-        mute = cfg["notifications"].get("quiet_notifications", True) and quiet_time()
-        jira_result = parse_jira_email(html)
+        # Разбор HTML — CPU‑работа, уводим её с event loop
+        jira_result = await asyncio.to_thread(parse_jira_email, html) if html else None
 
         if jira_result is None:
-            if not cfg["notifications"]["mail"]:
-                logging.info(f"[{user_id}] Пропускаем письмо от {sender}: у пользователя отключены email уведомления")
+            if not mail_enabled:
+                # заголовки таких писем не разбираются — в лог идёт UID
+                logger.info("[%s] Пропускаем письмо UID %s: у пользователя отключены email уведомления", user_id, uid)
                 continue
 
             msg_text = f"📩 Письмо от {escape_markdown(sender)}\n*Тема:* {escape_markdown(subject)}"
@@ -165,35 +341,28 @@ async def check_and_notify(app, user_id: int, cfg: dict):
                 parse_mode="Markdown",
                 disable_notification=mute,
             )
-            logging.info(f"[{user_id}] Отправлено уведомление о письме от {sender} (тихий режим: {mute})")
+            logger.info("[%s] Отправлено уведомление о письме от %s (тихий режим: %s)", user_id, sender, mute)
         else:
-            # Собираем все события из author_events
-            all_events = []
-            for author, events in jira_result['author_events'].items():
-                for event in events:
-                    event['author'] = author
-                    all_events.append(event)
-            
-            # Фильтруем события по allowed
-            filtered_events = [e for e in all_events if e['type'] in allowed]
-            if not filtered_events:
-                logging.info(f"[{user_id}] Пропускаем Jira письмо: парсер не нашел интересующих событий")
+            # Пары (автор, бит) только включённых у пользователя типов;
+            # письмо Jira, все события которого выключены, не уходит как обычное
+            events = [
+                (author, config.JIRA_BITS[event_type])
+                for author, event_type in jira_result['events']
+                if config.JIRA_BITS[event_type] & jira_mask
+            ]
+            if not events:
+                logger.info("[%s] Пропускаем Jira письмо: парсер не нашел интересующих событий", user_id)
                 continue
 
-            # Заменяем None авторов
-            valid_authors = [e['author'] for e in filtered_events if e['author'] is not None]
-            default_author = valid_authors[0] if valid_authors else "Кто-то"
-            for event in filtered_events:
-                if event['author'] is None:
-                    event['author'] = default_author
+            # События без автора приписываем первому известному автору
+            default_author = next((author for author, _ in events if author is not None), "Кто-то")
 
-            # Группируем события по автору
+            # Группируем события по автору: у каждого автора маска JIRA_BITS
             events_by_author = {}
-            for event in filtered_events:
-                author = event['author']
-                if author not in events_by_author:
-                    events_by_author[author] = []
-                events_by_author[author].append(event)
+            for author, bit in events:
+                if author is None:
+                    author = default_author
+                events_by_author[author] = events_by_author.get(author, 0) | bit
 
             # Формируем сообщение
             task_info = f"[{jira_result['task_key']}] {jira_result['task_summary']}"
@@ -201,25 +370,9 @@ async def check_and_notify(app, user_id: int, cfg: dict):
                 task_info = f'<a href="{jira_result["task_url"]}">{task_info}</a>'
             msg_lines = [task_info, ""]
 
-            for author, events in events_by_author.items():
+            for author, mask in events_by_author.items():
                 msg_lines.append(f"{author}:")
-                for event in events:
-                    event_type = event['type']
-
-                    if event_type == "assigned":
-                        msg_lines.append("✅ назначил(а) вас исполнителем задачи")
-                    elif event_type == "created":
-                        msg_lines.append("📌 создал(а) задачу")
-                    elif event_type == "update":
-                        msg_lines.append("✏️ внес(ла) изменения")
-                    elif event_type == "comment":
-                        msg_lines.append("💬 оставил(а) комментарий")
-                    elif event_type == "mention_description":
-                        msg_lines.append("👀 упомянул(а) вас в задаче")
-                    elif event_type == "mention_comment":
-                        msg_lines.append("👀 упомянул(а) вас в комментариях")
-                    elif event_type == "worklog":
-                        msg_lines.append("⏱️ трекнул(а) время")
+                msg_lines.extend(text for bit, text in _EVENT_LINES if mask & bit)
 
             msg_text = "\n".join(msg_lines)
             await app.bot.send_message(
@@ -228,7 +381,7 @@ async def check_and_notify(app, user_id: int, cfg: dict):
                 parse_mode="HTML",
                 disable_notification=mute,
             )
-            logging.info(f"[{user_id}] Отправлено Jira уведомление (тихий режим: {mute})")
+            logger.info("[%s] Отправлено Jira уведомление (тихий режим: %s)", user_id, mute)
 
 
         last_processed_uid = max(last_processed_uid or 0, uid)
@@ -237,6 +390,6 @@ async def check_and_notify(app, user_id: int, cfg: dict):
     config.update_user_fields(
         user_id,
         last_uid=last_processed_uid,
-        last_check_time=now_dt.isoformat(),
+        last_check_time=now_dt.isoformat(timespec="seconds"),
     )
-    logging.info(f"[{user_id}] Обновлена позиция последнего письма: {last_processed_uid}")
+    logger.info("[%s] Обновлена позиция последнего письма: %s", user_id, last_processed_uid)
@@ -1,17 +1,20 @@
 import os
+import hashlib
 import logging
 import asyncio
 from datetime import datetime
-from telegram.ext import ApplicationBuilder
+from telegram.ext import AIORateLimiter, ApplicationBuilder
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from dotenv import load_dotenv
+import uvloop
+
+# .env читаем до импорта модулей, которые берут настройки из окружения при импорте
+load_dotenv()
 
 from telegram import BotCommand
+from config import DATA_DIR
 from conversation import build_conversation_handler
-from mail_checker import check_mail_for_all_users
-from config import load_user_config, save_user_config
-
-load_dotenv()
+from mail_checker import check_mail_for_all_users, close_imap_connections
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 CHECK_INTERVAL = int(os.getenv("CHECK_INTERVAL", "60"))
@@ -22,6 +25,35 @@ LOG_LEVEL = logging._nameToLevel.get(LOG_LEVEL_NAME.upper(), logging.INFO)
 
 logging.basicConfig(level=LOG_LEVEL)
 
+# Команды для меню в Telegram
+BOT_COMMANDS = [
+    BotCommand("start", "Открыть главное меню"),
+    # Можно добавить и другие команды:
+    # BotCommand("help", "Вывести справку по боту"),
+    # BotCommand("status", "Проверить состояние бота"),
+]
+# Отпечаток последнего отправленного списка команд
+COMMANDS_STAMP_FILE = os.path.join(DATA_DIR, "bot_commands.stamp")
+
+async def ensure_bot_commands(bot):
+    """
+    set_my_commands только если список команд (или бот) изменился с прошлого запуска.
+    """
+    stamp = hashlib.blake2b(
+        repr((bot.id, [(c.command, c.description) for c in BOT_COMMANDS])).encode(),
+        digest_size=16,
+    ).hexdigest()
+    try:
+        with open(COMMANDS_STAMP_FILE) as f:
+            if f.read() == stamp:
+                return
+    except OSError:
+        pass
+
+    await bot.set_my_commands(BOT_COMMANDS)
+    with open(COMMANDS_STAMP_FILE, "w") as f:
+        f.write(stamp)
+
 async def scheduled_mail_check(app):
     """
     Запуск асинхронной проверки почты (для планировщика).
@@ -32,13 +64,8 @@ async def post_init(application):
     """
     Запуск планировщика после инициализации бота + установка команд.
     """
-    # Устанавливаем команды для меню в Telegram
-    await application.bot.set_my_commands([
-        BotCommand("start", "Открыть главное меню"),
-        # Можно добавить и другие команды:
-        # BotCommand("help", "Вывести справку по боту"),
-        # BotCommand("status", "Проверить состояние бота"),
-    ])
+    # Устанавливаем команды для меню в Telegram (если изменились)
+    await ensure_bot_commands(application.bot)
     
     loop = asyncio.get_running_loop()
     scheduler = AsyncIOScheduler()
@@ -52,13 +79,28 @@ async def post_init(application):
     scheduler.start()
     logging.info("✅ Планировщик запущен")
 
+async def post_shutdown(application):
+    """
+    Закрытие сохранённых IMAP‑соединений при остановке бота.
+    """
+    close_imap_connections()
+
 def main():
-    load_user_config()
+    # uvloop вместо стандартного цикла: дешевле сетевой I/O к Telegram
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
-    app = ApplicationBuilder().token(BOT_TOKEN).post_init(post_init).build()
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        # Общая очередь отправки: пачки уведомлений не упираются в лимиты Telegram (429)
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Добавляем обработчик ошибок
-    app.add_error_handler(lambda u, c: logging.error(f"Ошибка: {c.error}"))
+    app.add_error_handler(lambda u, c: logging.error("Ошибка: %s", c.error))
 
     # Регистрируем conversation handler
     conv_handler = build_conversation_handler()
@@ -1,56 +1,189 @@
-from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse
-import requests
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from fastapi import BackgroundTasks, FastAPI, Request
+from fastapi.responses import HTMLResponse, RedirectResponse
+import httpx
 import os
+from urllib.parse import quote, quote_plus, urlencode
 
-from config import load_user_config, set_email_credentials
+from config import set_email_credentials
+from mail_checker import bookmark_latest_uid
 
-load_user_config()
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Один асинхронный клиент на процесс: запросы не блокируют event loop,
+    # keep‑alive соединения к oauth.yandex.ru, login.yandex.ru и api.telegram.org
+    # переиспользуются между колбэками; HTTP/2 мультиплексирует всплеск
+    # sendMessage в одно соединение вместо TLS‑рукопожатия на каждый колбэк
+    app.state.http = httpx.AsyncClient(
+        timeout=10,
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=2,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+        ),
+    )
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 YANDEX_CLIENT_ID = os.getenv("YANDEX_CLIENT_ID")
 YANDEX_CLIENT_SECRET = os.getenv("YANDEX_CLIENT_SECRET")
 REDIRECT_URI = os.getenv("YANDEX_REDIRECT_URI")
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+TOKEN_URL = "https://oauth.yandex.ru/token"
 INFO_URL = "https://login.yandex.ru/info?format=json"
+TG_SEND_URL = (
+    f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage" if BOT_TOKEN else None
+)
+
+# Форма обмена кода на токен закодирована заранее: на запрос меняется только code
+_TOKEN_FORM_HEAD = b"grant_type=authorization_code&code="
+_TOKEN_FORM_TAIL = (
+    "&"
+    + urlencode(
+        {
+            "client_id": YANDEX_CLIENT_ID or "",
+            "client_secret": YANDEX_CLIENT_SECRET or "",
+        }
+    )
+).encode()
+_FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+
+# access_token → (истекает, default_email): повторная авторизация тем же токеном
+# обходится без запроса к /info
+_EMAIL_CACHE_TTL = 3600
+_EMAIL_CACHE_SIZE = 1024
+_email_cache = OrderedDict()
+
+
+def _cached_email(token: str):
+    entry = _email_cache.get(token)
+    if entry is None:
+        return None
+    expires, email = entry
+    if expires <= time.monotonic():
+        del _email_cache[token]
+        return None
+    return email
+
+
+def _remember_email(token: str, email: str) -> None:
+    _email_cache[token] = (time.monotonic() + _EMAIL_CACHE_TTL, email)
+    _email_cache.move_to_end(token)
+    if len(_email_cache) > _EMAIL_CACHE_SIZE:
+        _email_cache.popitem(last=False)
 
 
-def tpl(body: str, auto_close: bool = False) -> str:
-    return f"""<!DOCTYPE html><html><head><meta charset="utf-8">
+# HTML‑обёртка страниц собрана один раз: на запрос — только склейка байтов
+_TPL_HEAD = """<!DOCTYPE html><html><head><meta charset="utf-8">
 <title>Авторизация Yandex</title>
 <style>
-:root{{--bg:#f5f7fa;--card:#fff;--accent:#1a73e8;--txt:#2b2f33}}
-*{{box-sizing:border-box}}body{{margin:0;height:100vh;display:flex;align-items:center;justify-content:center;
-font-family:-apple-system,BlinkMacSystemFont,"Segoe UI",Roboto,Oxygen,Ubuntu,Cantarell,"Open Sans","Helvetica Neue",sans-serif;background:var(--bg)}}
-.card{{max-width:420px;padding:2.5rem 3rem;background:var(--card);border-radius:1rem;box-shadow:0 10px 30px rgba(0,0,0,.08);text-align:center}}
-h1{{margin:0 0 .5rem;font-size:1.6rem;color:var(--txt)}}p{{margin:.25rem 0 0;font-size:1rem;color:#575c60}}
-.accent{{color:var(--accent);font-weight:600;word-break:break-all}}
-</style>{'<script>setTimeout(()=>window.close(),3000);</script>' if auto_close else ''}
-</head><body><div class="card">{body}</div></body></html>"""
+:root{--bg:#f5f7fa;--card:#fff;--accent:#1a73e8;--txt:#2b2f33}
+*{box-sizing:border-box}body{margin:0;height:100vh;display:flex;align-items:center;justify-content:center;
+font-family:-apple-system,BlinkMacSystemFont,"Segoe UI",Roboto,Oxygen,Ubuntu,Cantarell,"Open Sans","Helvetica Neue",sans-serif;background:var(--bg)}
+.card{max-width:420px;padding:2.5rem 3rem;background:var(--card);border-radius:1rem;box-shadow:0 10px 30px rgba(0,0,0,.08);text-align:center}
+h1{margin:0 0 .5rem;font-size:1.6rem;color:var(--txt)}p{margin:.25rem 0 0;font-size:1rem;color:#575c60}
+.accent{color:var(--accent);font-weight:600;word-break:break-all}
+</style>"""
+_TPL_AUTO_CLOSE = "<script>setTimeout(()=>window.close(),3000);</script>"
+_TPL_BODY_OPEN = """
+</head><body><div class="card">"""
+_PAGE_HEAD = (_TPL_HEAD + _TPL_BODY_OPEN).encode()
+_PAGE_HEAD_AUTO_CLOSE = (_TPL_HEAD + _TPL_AUTO_CLOSE + _TPL_BODY_OPEN).encode()
+_PAGE_TAIL = b"</div></body></html>"
+
+
+def tpl(body: str, auto_close: bool = False) -> bytes:
+    head = _PAGE_HEAD_AUTO_CLOSE if auto_close else _PAGE_HEAD
+    return head + body.encode() + _PAGE_TAIL
+
+
+# Страница успеха одна на всех: адрес подставляет браузер из ?email=
+_OK_PAGE = tpl(
+    "<h1>✅ Почта <span class='accent' id='e'></span> подключена</h1>"
+    "<p>Окно закроется автоматически.</p>"
+    "<script>document.getElementById('e').textContent="
+    "new URLSearchParams(location.search).get('email')||'';</script>",
+    auto_close=True,
+)
+
+# Страницы ошибок без переменных частей тоже собраны заранее
+_NO_CODE_PAGE = tpl("<h1>❌ Ошибка</h1><p>Не получен code</p>")
+_BAD_STATE_PAGE = tpl("<h1>❌ Ошибка</h1><p>Некорректный state</p>")
+
+
+# 429 от Telegram (массовая переавторизация) и 5xx шлюза повторяем с паузой:
+# Retry-After, если он есть, иначе экспоненциальный backoff
+_TG_RETRIES = 3
+_TG_BACKOFF = 0.5
+_TG_MAX_DELAY = 30.0
+_TG_RETRY_STATUSES = frozenset({429, 502, 503, 504})
+
+
+def _retry_delay(resp: httpx.Response, attempt: int) -> float:
+    try:
+        delay = float(resp.headers["Retry-After"])
+    except (KeyError, ValueError):
+        delay = _TG_BACKOFF * 2**attempt
+    return min(delay, _TG_MAX_DELAY)
+
+
+async def notify_telegram(http: httpx.AsyncClient, user_id: int, email: str) -> None:
+    """Сообщение в Telegram о подключённой почте (ошибки сети не критичны)."""
+    data = {
+        "chat_id": user_id,
+        "text": (
+            f"✅ Почта *{email}* подключена!\n"
+            "Уведомления о письмах включены.\n\n"
+            "Введите /start, чтобы перейти к настройкам."
+        ),
+        "parse_mode": "Markdown",
+        "disable_web_page_preview": True,
+    }
+    for attempt in range(_TG_RETRIES + 1):
+        try:
+            resp = await http.post(TG_SEND_URL, data=data, timeout=5)
+        except httpx.HTTPError:
+            return
+        if resp.status_code not in _TG_RETRY_STATUSES or attempt == _TG_RETRIES:
+            return
+        await asyncio.sleep(_retry_delay(resp, attempt))
 
 
 @app.get("/callback", response_class=HTMLResponse)
-async def yandex_callback(request: Request):
+async def yandex_callback(request: Request, background_tasks: BackgroundTasks):
     code = request.query_params.get("code")
     user_id = request.query_params.get("state")
 
     if not code:
-        return HTMLResponse(tpl("<h1>❌ Ошибка</h1><p>Не получен code</p>"), 400)
+        return HTMLResponse(_NO_CODE_PAGE, 400)
+
+    # state = Telegram user_id; битый state отсекаем до обмена кода на токен
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return HTMLResponse(_BAD_STATE_PAGE, 400)
+
+    http = request.app.state.http
 
     # 1️⃣ access_token
-    tok = requests.post(
-        "https://oauth.yandex.ru/token",
-        data={
-            "grant_type": "authorization_code",
-            "code": code,
-            "client_id": YANDEX_CLIENT_ID,
-            "client_secret": YANDEX_CLIENT_SECRET,
-        },
+    tok = await http.post(
+        TOKEN_URL,
+        content=_TOKEN_FORM_HEAD + quote_plus(code).encode() + _TOKEN_FORM_TAIL,
+        headers=_FORM_HEADERS,
         timeout=10,
     )
-    if not tok.ok:
+    if not tok.is_success:
         return HTMLResponse(
             tpl(
                 "<h1>❌ Ошибка</h1><p>Не удалось получить токен:<br>"
@@ -59,48 +192,37 @@ async def yandex_callback(request: Request):
             500,
         )
 
-    token = tok.json().get("access_token")
+    token_data = tok.json()
+    token = token_data.get("access_token")
 
     # 2️⃣ e‑mail
-    info = requests.get(
-        INFO_URL, headers={"Authorization": f"OAuth {token}"}, timeout=5
-    )
-    email = (info.json().get("default_email") if info.ok else None) or (
-        f"{tok.json().get('uid', 'unknown')}@yandex.ru"
+    email = _cached_email(token)
+    if email is None:
+        info = await http.get(
+            INFO_URL, headers={"Authorization": f"OAuth {token}"}, timeout=5
+        )
+        email = info.json().get("default_email") if info.is_success else None
+        if email:
+            _remember_email(token, email)
+    email = email or f"{token_data.get('uid', 'unknown')}@yandex.ru"
+
+    # 3️⃣ + 4️⃣ сохраняем почту/токен и ставим UID‑закладку одновременно:
+    # они пишут разные колонки; запись в SQLite — в потоке, не на event loop
+    await asyncio.gather(
+        asyncio.to_thread(set_email_credentials, user_id, email, token),
+        bookmark_latest_uid(user_id, email, token),
     )
 
-    # 3️⃣ сохраняем почту/токен
-    set_email_credentials(int(user_id), email, token)
+    # 5️⃣ сообщение в Telegram — уже после отправки HTML, браузер его не ждёт
+    if TG_SEND_URL:
+        background_tasks.add_task(notify_telegram, http, user_id, email)
 
-    # 4️⃣ UID‑закладка  —  импортим ЛЕНИВО, чтобы избежать раннего цикла
-    from mail_checker import bookmark_latest_uid  # noqa: WPS433  (локальный импорт)
-    await bookmark_latest_uid(int(user_id), email, token)
+    # 6️⃣ редирект на статичную страницу успеха; путь относительный —
+    # работает и за прокси с префиксом
+    return RedirectResponse(f"ok?email={quote(email)}", status_code=303)
 
-    # 5️⃣ сообщение в Telegram
-    if BOT_TOKEN:
-        try:
-            requests.post(
-                f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage",
-                data={
-                    "chat_id": user_id,
-                    "text": (
-                        f"✅ Почта *{email}* подключена!\n"
-                        "Уведомления о письмах включены.\n\n"
-                        "Введите /start, чтобы перейти к настройкам."
-                    ),
-                    "parse_mode": "Markdown",
-                    "disable_web_page_preview": True,
-                },
-                timeout=5,
-            )
-        except requests.RequestException:
-            pass
-
-    # 6️⃣ HTML‑ответ
-    return HTMLResponse(
-        tpl(
-            f"<h1>✅ Почта <span class='accent'>{email}</span> подключена</h1>"
-            "<p>Окно закроется автоматически.</p>",
-            auto_close=True,
-        )
-    )
+
+@app.get("/ok", response_class=HTMLResponse)
+async def ok_page():
+    # объект ответа — свой на запрос: FastAPI и middleware меняют его на месте
+    return HTMLResponse(_OK_PAGE)